@@ -21,6 +21,39 @@ from appwrite.input_file import InputFile
 # InkStitch microservice URL (Docker internal network or LAN IP)
 INKSTITCH_URL = os.environ.get("INKSTITCH_URL", "http://192.168.30.100:5021")
 
+# Keep-alive session for the microservice, shared across warm invocations
+INKSTITCH_SESSION = requests.Session()
+
+
+# Appwrite services cached at module scope so a warm container reuses them,
+# keyed on the environment config they were built from
+_APPWRITE_SERVICES = None
+_APPWRITE_CONFIG = None
+
+
+def get_appwrite_services():
+    """
+    Return (storage, databases), building the client only on first use or
+    when the endpoint/project/key environment variables change.
+    """
+    global _APPWRITE_SERVICES, _APPWRITE_CONFIG
+    
+    config = (
+        os.environ.get('APPWRITE_ENDPOINT', 'https://appwrite.friborg.uk/v1'),
+        os.environ.get('APPWRITE_PROJECT_ID'),
+        os.environ.get('APPWRITE_API_KEY'),
+    )
+    if _APPWRITE_SERVICES is None or config != _APPWRITE_CONFIG:
+        endpoint, project, key = config
+        client = Client()
+        client.set_endpoint(endpoint)
+        client.set_project(project)
+        client.set_key(key)
+        _APPWRITE_SERVICES = (Storage(client), Databases(client))
+        _APPWRITE_CONFIG = config
+    
+    return _APPWRITE_SERVICES
+
 
 def main(context):
     try:
@@ -36,14 +69,8 @@ def main(context):
         if not project_id:
             return context.res.json({'success': False, 'error': 'Missing projectId'}, 400)
         
-        # Initialize Appwrite client
-        client = Client()
-        client.set_endpoint(os.environ.get('APPWRITE_ENDPOINT', 'https://appwrite.friborg.uk/v1'))
-        client.set_project(os.environ.get('APPWRITE_PROJECT_ID'))
-        client.set_key(os.environ.get('APPWRITE_API_KEY'))
-        
-        storage = Storage(client)
-        databases = Databases(client)
+        # Appwrite services (reused across warm invocations)
+        storage, databases = get_appwrite_services()
         
         # Get project data
         context.log('Fetching project...')
@@ -91,7 +118,7 @@ def main(context):
             'file': ('design.png', io.BytesIO(file_data), 'image/png'),
         }
         
-        response = requests.post(
+        response = INKSTITCH_SESSION.post(
             f'{INKSTITCH_URL}/image-to-pes',
             files={**files, **form_data},
             timeout=120
@@ -122,6 +149,7 @@ def main(context):
         
         # Generate preview using pyembroidery (if available)
         preview_file = None
+        stitch_count = 0
         try:
             import pyembroidery
             pattern = pyembroidery.read_pes(io.BytesIO(pes_data))
@@ -139,11 +167,10 @@ def main(context):
                     )
                     context.log(f'Preview generated: {len(preview_data)} bytes')
                 
-                stitch_count = len([s for s in pattern.stitches if s[2] == 0])  # Regular stitches
+                stitch_count = pattern.count_stitch_commands(pyembroidery.STITCH)  # Regular stitches
                 context.log(f'Stitch count: {stitch_count}')
         except Exception as e:
             context.log(f'Preview generation skipped: {e}')
-            stitch_count = 0
         
         # Update project document
         update_data = {
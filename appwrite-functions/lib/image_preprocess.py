@@ -28,6 +28,9 @@ HOOP_SPECS = {
 # Default DPI for mm conversion (10 pixels per mm)
 DEFAULT_PX_PER_MM = 10
 
+# Inputs are downscaled to at most this multiple of the safe area up front
+WORKING_SIZE_FACTOR = 2
+
 
 def preprocess_for_embroidery(image_np, hoop_size='100x100', use_grabcut=True):
     """
@@ -45,28 +48,44 @@ def preprocess_for_embroidery(image_np, hoop_size='100x100', use_grabcut=True):
     """
     spec = HOOP_SPECS.get(hoop_size, HOOP_SPECS['100x100'])
     
+    safe_w_px = spec['safe_width_mm'] * DEFAULT_PX_PER_MM
+    safe_h_px = spec['safe_height_mm'] * DEFAULT_PX_PER_MM
+    
+    # Stage 0: Segment on a working copy downscaled to at most 2x the safe
+    # area; the full-resolution input is kept for the crop in Stage 4
+    work_np = downscale_to_fit(
+        image_np, WORKING_SIZE_FACTOR * safe_w_px, WORKING_SIZE_FACTOR * safe_h_px
+    )
+    
     # Stage 1: Denoise
-    denoised = denoise_bilateral(image_np)
+    denoised = denoise_bilateral(work_np)
     
     # Stage 2: Background removal
     if use_grabcut:
         try:
             fg_mask = remove_background_threshold(denoised)
         except Exception:
-            fg_mask = np.ones(denoised.shape[:2], dtype=np.uint8) * 255
+            fg_mask = np.full(denoised.shape[:2], 255, dtype=np.uint8)
     else:
-        fg_mask = np.ones(denoised.shape[:2], dtype=np.uint8) * 255
+        fg_mask = np.full(denoised.shape[:2], 255, dtype=np.uint8)
     
     # Stage 3: Clean up mask with morphological operations
     fg_mask = clean_mask(fg_mask)
     
-    # Stage 4: Crop to content
-    cropped, cropped_mask = crop_to_content(denoised, fg_mask)
+    # Stage 4: Crop to content. If the working copy was downscaled, crop the
+    # full-resolution input instead, so a subject that is small in a large
+    # frame still has the pixels to fill the safe area
+    if work_np is image_np:
+        cropped, cropped_mask = crop_to_content(denoised, fg_mask)
+    else:
+        cropped, cropped_mask = crop_full_resolution(image_np, fg_mask)
+        cropped = downscale_to_fit(
+            cropped, WORKING_SIZE_FACTOR * safe_w_px, WORKING_SIZE_FACTOR * safe_h_px
+        )
+        cropped_mask = resize_mask(cropped_mask, cropped.shape[1], cropped.shape[0])
+        cropped = denoise_bilateral(cropped)
     
     # Stage 5: Resize to safe area
-    safe_w_px = spec['safe_width_mm'] * DEFAULT_PX_PER_MM
-    safe_h_px = spec['safe_height_mm'] * DEFAULT_PX_PER_MM
-    
     resized, resized_mask = resize_preserve_aspect(
         cropped, cropped_mask, safe_w_px, safe_h_px
     )
@@ -94,21 +113,41 @@ def preprocess_for_embroidery(image_np, hoop_size='100x100', use_grabcut=True):
     return centered, centered_mask, dimensions
 
 
+def downscale_to_fit(image_np, max_w, max_h):
+    """Downscale image (never upscale) to fit within max dimensions."""
+    h, w = image_np.shape[:2]
+    
+    if w <= max_w and h <= max_h:
+        return image_np
+    
+    pil_img = Image.fromarray(image_np)
+    pil_img.thumbnail((max_w, max_h), Image.Resampling.LANCZOS)
+    return np.array(pil_img)
+
+
 def denoise_bilateral(image_np, sigma_color=0.05, sigma_spatial=10):
     """
-    Bilateral-like denoising using PIL's edge-preserving smooth filter.
-    Preserves edges while reducing noise.
+    Edge-preserving denoise via a self-guided filter (He et al.).
+    
+    Same role as a bilateral filter, with sigma_color acting as the edge
+    threshold (regularisation eps = sigma_color^2, in [0, 1] intensity units)
+    and sigma_spatial as the box radius. Built from box means, so the cost is
+    O(pixels) regardless of radius, unlike skimage's windowed bilateral.
     """
     try:
-        from skimage.restoration import denoise_bilateral as skimage_bilateral
-        # skimage bilateral works on float images [0,1]
-        img_float = image_np.astype(np.float64) / 255.0
-        denoised = skimage_bilateral(
-            img_float,
-            sigma_color=sigma_color,
-            sigma_spatial=sigma_spatial,
-            channel_axis=-1
-        )
+        from scipy import ndimage
+        
+        img = image_np.astype(np.float32) / 255.0
+        size = (2 * sigma_spatial + 1, 2 * sigma_spatial + 1, 1)  # per channel
+        
+        mean = ndimage.uniform_filter(img, size)
+        var = ndimage.uniform_filter(img * img, size) - mean * mean
+        
+        # Flat areas (var << eps) take the local mean, edges (var >> eps) keep the pixel
+        a = var / (var + sigma_color ** 2)
+        b = mean - a * mean
+        denoised = ndimage.uniform_filter(a, size) * img + ndimage.uniform_filter(b, size)
+        
         return (denoised * 255).clip(0, 255).astype(np.uint8)
     except ImportError:
         # Fallback to PIL smooth filter
@@ -117,17 +156,49 @@ def denoise_bilateral(image_np, sigma_color=0.05, sigma_spatial=10):
         return np.array(smoothed)
 
 
+# Longest side background segmentation runs at; the coarse mask is upscaled
+BG_REMOVAL_MAX_SIDE = 512
+
+# ITU-R 709 luma weights (same as skimage.color.rgb2gray), pre-scaled from 0-255
+GRAY_WEIGHTS = np.array([0.2125, 0.7154, 0.0721], dtype=np.float32) / 255
+
+
+def to_gray(image_np):
+    """
+    Convert a uint8 RGB array to float32 luminance in [0, 1].
+    
+    Matches rgb2gray, but goes straight from uint8 to float32 in one
+    weighted sum instead of first promoting the whole image to float64.
+    """
+    return image_np[..., :3] @ GRAY_WEIGHTS
+
+
 def remove_background_threshold(image_np):
     """
     Background removal using edge detection + flood fill approach.
     Works without OpenCV's GrabCut.
+    
+    Images larger than BG_REMOVAL_MAX_SIDE are segmented on a downscaled
+    copy and the mask is scaled back up with nearest-neighbour; clean_mask
+    smooths out the resulting stair-steps.
     """
+    h, w = image_np.shape[:2]
+    small = downscale_to_fit(image_np, BG_REMOVAL_MAX_SIDE, BG_REMOVAL_MAX_SIDE)
+    mask = edge_fill_mask(small)
+    
+    if small.shape[:2] != (h, w):
+        mask = np.array(Image.fromarray(mask).resize((w, h), Image.Resampling.NEAREST))
+    
+    return mask
+
+
+def edge_fill_mask(image_np):
+    """Foreground mask (0/255) from Sobel edges, gap closing and hole filling."""
     try:
         from skimage.filters import sobel
-        from skimage.color import rgb2gray
         from scipy import ndimage
         
-        gray = rgb2gray(image_np)  # Returns float [0, 1]
+        gray = to_gray(image_np)  # float32 [0, 1]
         
         # Edge detection
         edges = sobel(gray)
@@ -136,25 +207,22 @@ def remove_background_threshold(image_np):
         threshold = np.mean(edges) + np.std(edges)
         edge_mask = edges > threshold
         
-        # Dilate edges to close gaps
-        struct = ndimage.generate_binary_structure(2, 2)
-        closed_edges = ndimage.binary_dilation(edge_mask, struct, iterations=3)
-        closed_edges = ndimage.binary_closing(closed_edges, struct, iterations=2)
+        # Dilate edges to close gaps: 3x dilation then a 2x closing with the
+        # 3x3 structure is a dilation by an 11x11 square then an erosion by 5x5
+        closed_edges = square_erode(square_dilate(edge_mask, 11), 5)
         
         # Fill holes to get foreground
         filled = ndimage.binary_fill_holes(closed_edges)
         
         # If the filled region is too small or too large, use center-based approach
-        fill_ratio = np.sum(filled) / filled.size
+        fill_ratio = np.count_nonzero(filled) / filled.size
         if fill_ratio < 0.05 or fill_ratio > 0.95:
             # Fallback: assume center is foreground, edges are background
             h, w = gray.shape
-            center_mask = np.zeros_like(gray, dtype=bool)
             margin = min(h, w) // 10
-            center_mask[margin:h-margin, margin:w-margin] = True
             
-            # Use luminance threshold
-            mean_center = np.mean(gray[center_mask])
+            # Use luminance threshold (center window is a view, no scratch mask)
+            mean_center = np.mean(gray[margin:h-margin, margin:w-margin])
             mean_border = np.mean(np.concatenate([
                 gray[0, :], gray[-1, :], gray[:, 0], gray[:, -1]
             ]))
@@ -167,14 +235,36 @@ def remove_background_threshold(image_np):
                 fg_mask = gray > (mean_border + 0.1)
             
             fg_mask = ndimage.binary_fill_holes(fg_mask)
-            fg_mask = ndimage.binary_closing(fg_mask, struct, iterations=3)
+            fg_mask = square_erode(square_dilate(fg_mask, 7), 7)
             filled = fg_mask
         
-        return (filled.astype(np.uint8) * 255)
+        return bool_to_mask(filled)
         
     except ImportError:
         # Ultimate fallback: no background removal
-        return np.ones(image_np.shape[:2], dtype=np.uint8) * 255
+        return np.full(image_np.shape[:2], 255, dtype=np.uint8)
+
+
+def square_dilate(mask, size):
+    """
+    Binary dilation by a size x size square.
+    
+    Equivalent to iterating ndimage.binary_dilation with the full 3x3
+    structure (size - 1) // 2 times, but runs as two separable 1-D max passes.
+    """
+    from scipy import ndimage
+    return ndimage.maximum_filter(mask, size=size, mode='constant', cval=0)
+
+
+def square_erode(mask, size):
+    """Binary erosion by a size x size square (zero border, like binary_erosion)."""
+    from scipy import ndimage
+    return ndimage.minimum_filter(mask, size=size, mode='constant', cval=0)
+
+
+def bool_to_mask(binary):
+    """Convert a boolean array to a 0/255 uint8 mask in one pass (no 0/1 intermediate)."""
+    return np.multiply(binary, 255, dtype=np.uint8)
 
 
 def clean_mask(mask, close_size=5, open_size=3):
@@ -188,35 +278,68 @@ def clean_mask(mask, close_size=5, open_size=3):
         # Remove small noise
         binary = opening(binary, disk(open_size))
         
-        return (binary.astype(np.uint8) * 255)
+        return bool_to_mask(binary)
     except ImportError:
         from scipy import ndimage
         binary = mask > 127
         struct = np.ones((close_size, close_size))
         binary = ndimage.binary_closing(binary, struct)
         binary = ndimage.binary_opening(binary, np.ones((open_size, open_size)))
-        return (binary.astype(np.uint8) * 255)
+        return bool_to_mask(binary)
 
 
 def crop_to_content(image_np, mask):
     """Crop image and mask to the bounding box of the mask content."""
+    y_min, y_max, x_min, x_max = content_box(mask)
+    return image_np[y_min:y_max+1, x_min:x_max+1], mask[y_min:y_max+1, x_min:x_max+1]
+
+
+def crop_full_resolution(image_np, mask):
+    """
+    Crop a full-resolution image to the content of a mask computed on a
+    downscaled copy of it; the mask crop is scaled up to match (nearest).
+    """
+    h, w = image_np.shape[:2]
+    mh, mw = mask.shape[:2]
+    y_min, y_max, x_min, x_max = content_box(mask)
+    
+    # Mask pixel edges -> image pixel edges
+    sy, sx = h / mh, w / mw
+    top, bottom = int(np.floor(y_min * sy)), min(h, int(np.ceil((y_max + 1) * sy)))
+    left, right = int(np.floor(x_min * sx)), min(w, int(np.ceil((x_max + 1) * sx)))
+    
+    cropped = image_np[top:bottom, left:right]
+    cropped_mask = resize_mask(
+        mask[y_min:y_max+1, x_min:x_max+1], cropped.shape[1], cropped.shape[0]
+    )
+    return cropped, cropped_mask
+
+
+def content_box(mask, pad=5):
+    """Inclusive (y_min, y_max, x_min, x_max) of the mask content plus padding; whole mask if empty."""
+    h, w = mask.shape[:2]
     coords = np.argwhere(mask > 127)
     
     if len(coords) == 0:
-        return image_np, mask
+        return 0, h - 1, 0, w - 1
     
     y_min, x_min = coords.min(axis=0)
     y_max, x_max = coords.max(axis=0)
     
     # Add small padding
-    pad = 5
-    h, w = image_np.shape[:2]
     y_min = max(0, y_min - pad)
     x_min = max(0, x_min - pad)
     y_max = min(h - 1, y_max + pad)
     x_max = min(w - 1, x_max + pad)
     
-    return image_np[y_min:y_max+1, x_min:x_max+1], mask[y_min:y_max+1, x_min:x_max+1]
+    return y_min, y_max, x_min, x_max
+
+
+def resize_mask(mask, width, height):
+    """Nearest-neighbour resize of a uint8 mask (no-op if already that size)."""
+    if mask.shape[1] == width and mask.shape[0] == height:
+        return mask
+    return np.array(Image.fromarray(mask).resize((width, height), Image.Resampling.NEAREST))
 
 
 def resize_preserve_aspect(image_np, mask, max_w, max_h):
@@ -233,9 +356,9 @@ def resize_preserve_aspect(image_np, mask, max_w, max_h):
     new_w = max(1, int(w * scale))
     new_h = max(1, int(h * scale))
     
-    # Use PIL for high-quality resize
+    # Use PIL for high-quality resize (large factors box-reduce first)
     pil_img = Image.fromarray(image_np)
-    pil_img = pil_img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+    pil_img = pil_img.resize((new_w, new_h), Image.Resampling.LANCZOS, reducing_gap=3.0)
     
     pil_mask = Image.fromarray(mask)
     pil_mask = pil_mask.resize((new_w, new_h), Image.Resampling.NEAREST)
@@ -247,7 +370,7 @@ def center_in_canvas(image_np, mask, canvas_w, canvas_h):
     """Center image and mask in a white canvas of given size."""
     h, w = image_np.shape[:2]
     
-    canvas = np.ones((canvas_h, canvas_w, 3), dtype=np.uint8) * 255
+    canvas = np.full((canvas_h, canvas_w, 3), 255, dtype=np.uint8)
     mask_canvas = np.zeros((canvas_h, canvas_w), dtype=np.uint8)
     
     offset_x = (canvas_w - w) // 2
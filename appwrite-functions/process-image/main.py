@@ -9,6 +9,8 @@ import os
 import io
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from PIL import Image, ImageDraw
 from appwrite.client import Client
@@ -29,6 +31,40 @@ except ImportError as e:
     PHASE2_ERROR = str(e)
 
 
+# Log the parsed request payload (set DEBUG_PAYLOAD=1 in the function env)
+DEBUG_PAYLOAD = bool(os.environ.get('DEBUG_PAYLOAD'))
+
+
+# Appwrite services cached at module scope so a warm container reuses them,
+# keyed on the environment config they were built from
+_APPWRITE_SERVICES = None
+_APPWRITE_CONFIG = None
+
+
+def get_appwrite_services():
+    """
+    Return (storage, databases), building the client only on first use or
+    when the endpoint/project/key environment variables change.
+    """
+    global _APPWRITE_SERVICES, _APPWRITE_CONFIG
+    
+    config = (
+        os.environ.get('APPWRITE_ENDPOINT', 'https://cloud.appwrite.io/v1'),
+        os.environ.get('APPWRITE_PROJECT_ID'),
+        os.environ.get('APPWRITE_API_KEY'),
+    )
+    if _APPWRITE_SERVICES is None or config != _APPWRITE_CONFIG:
+        endpoint, project, key = config
+        client = Client()
+        client.set_endpoint(endpoint)
+        client.set_project(project)
+        client.set_key(key)
+        _APPWRITE_SERVICES = (Storage(client), Databases(client))
+        _APPWRITE_CONFIG = config
+    
+    return _APPWRITE_SERVICES
+
+
 def main(context):
     """
     Main entry point for Appwrite function.
@@ -44,6 +80,7 @@ def main(context):
     try:
         # Parse request body - try all Appwrite 1.8 body accessors
         payload = {}
+        payload_source = None
         
         # Try body_text first (Appwrite 1.8 snake_case), then bodyText, then body
         for attr in ['body_text', 'bodyText', 'body_raw', 'bodyRaw', 'body']:
@@ -51,7 +88,7 @@ def main(context):
                 val = getattr(context.req, attr, None)
                 if val and isinstance(val, str) and val.strip():
                     payload = json.loads(val)
-                    context.log(f"Parsed payload from {attr}")
+                    payload_source = attr
                     break
             except Exception:
                 continue
@@ -63,7 +100,7 @@ def main(context):
                     val = getattr(context.req, attr, None)
                     if val and isinstance(val, dict):
                         payload = val
-                        context.log(f"Parsed payload from {attr}")
+                        payload_source = attr
                         break
                 except Exception:
                     continue
@@ -72,11 +109,14 @@ def main(context):
         if isinstance(payload, dict) and 'data' in payload and isinstance(payload['data'], str):
             try:
                 payload = json.loads(payload['data'])
-                context.log("Unwrapped data wrapper")
+                payload_source = f'{payload_source} (data wrapper)'
             except Exception:
                 pass
         
-        context.log(f"Payload: {json.dumps(payload) if isinstance(payload, dict) else str(payload)}")
+        # Dumping the payload is debug-only; it is serialized on every call otherwise
+        if DEBUG_PAYLOAD:
+            context.log(f"Payload from {payload_source}: "
+                        f"{json.dumps(payload) if isinstance(payload, dict) else str(payload)}")
         
         project_id = payload.get('projectId') if isinstance(payload, dict) else None
         image_id = payload.get('imageId') if isinstance(payload, dict) else None
@@ -93,14 +133,8 @@ def main(context):
             context.log(f'Phase 2 modules not available: {PHASE2_ERROR}')
             context.log('Falling back to legacy processing...')
         
-        # Initialize Appwrite client
-        client = Client()
-        client.set_endpoint(os.environ.get('APPWRITE_ENDPOINT', 'https://cloud.appwrite.io/v1'))
-        client.set_project(os.environ.get('APPWRITE_PROJECT_ID'))
-        client.set_key(os.environ.get('APPWRITE_API_KEY'))
-        
-        storage = Storage(client)
-        databases = Databases(client)
+        # Appwrite services (reused across warm invocations)
+        storage, databases = get_appwrite_services()
         
         # Download original image
         context.log('Downloading original image...')
@@ -109,8 +143,7 @@ def main(context):
             file_id=image_id
         )
         
-        image = Image.open(io.BytesIO(file_data))
-        image_np = np.array(image.convert('RGB'))
+        image_np = decode_image(file_data, hoop_size, full_resolution=PHASE2_AVAILABLE)
         
         context.log(f'Image loaded: {image_np.shape[1]}x{image_np.shape[0]} px')
         
@@ -162,48 +195,39 @@ def process_with_phase2(context, storage, databases, project_id, image_np, threa
     
     context.log(f'  Found {len(regions)} regions')
     
-    fill_count = sum(1 for r in regions if r.region_type == 'fill')
-    outline_count = sum(1 for r in regions if r.region_type == 'outline')
-    detail_count = sum(1 for r in regions if r.region_type == 'detail')
-    context.log(f'  Types: {fill_count} fill, {outline_count} outline, {detail_count} detail')
-    
-    # Stage 3: Generate outline visualization
-    context.log('Stage 3: Generating outline preview...')
-    outline_image = generate_outline_preview(quantized_image, regions)
+    summary = summarize_regions(regions)
+    context.log(f'  Types: {summary["fill_count"]} fill, {summary["outline_count"]} outline, '
+                f'{summary["detail_count"]} detail')
     
-    # Upload processed image
-    context.log('Uploading processed image...')
-    processed_pil = Image.fromarray(quantized_image)
-    buffer = io.BytesIO()
-    processed_pil.save(buffer, format='PNG')
-    buffer.seek(0)
-    
-    processed_file = storage.create_file(
-        bucket_id='project_images',
-        file_id='unique()',
-        file=InputFile.from_bytes(buffer.read(), f'{project_id}_processed.png')
-    )
-    
-    # Upload outline image
-    outline_file_id = None
-    if outline_image is not None:
-        outline_pil = Image.fromarray(outline_image)
-        outline_buffer = io.BytesIO()
-        outline_pil.save(outline_buffer, format='PNG')
-        outline_buffer.seek(0)
-        
-        outline_file = storage.create_file(
-            bucket_id='project_images',
-            file_id='unique()',
-            file=InputFile.from_bytes(outline_buffer.read(), f'{project_id}_outlines.png')
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # Encode + upload the processed image in the background while the
+        # outline preview is drawn (both only read quantized_image)
+        context.log('Uploading processed image...')
+        processed_upload = pool.submit(
+            encode_and_upload, storage, quantized_image, f'{project_id}_processed.png'
         )
-        outline_file_id = outline_file['$id']
-    
-    # Prepare region data for stitch planning
-    region_data = serialize_regions(regions)
-    
-    # Convert color palette to hex
-    color_hex_list = [rgb_to_hex(c) for c in color_palette]
+        
+        # Stage 3: Generate outline visualization
+        context.log('Stage 3: Generating outline preview...')
+        outline_image = generate_outline_preview(quantized_image, regions)
+        
+        # Encode + upload outline image on the second worker (PIL's PNG
+        # encoder releases the GIL, so both encodes run in parallel)
+        outline_upload = None
+        if outline_image is not None:
+            outline_upload = pool.submit(
+                encode_and_upload, storage, outline_image, f'{project_id}_outlines.png'
+            )
+        
+        # Prepare region data for stitch planning
+        region_data = serialize_regions(regions, summary)
+        
+        # Convert color palette to hex
+        color_hex_list = palette_to_hex(color_palette)
+        
+        # Wait for uploads only once their IDs are needed
+        processed_file = processed_upload.result()
+        outline_file_id = outline_upload.result()['$id'] if outline_upload is not None else None
     
     # Update project document
     context.log('Updating project...')
@@ -215,7 +239,7 @@ def process_with_phase2(context, storage, databases, project_id, image_np, threa
     
     if outline_file_id:
         update_data['outlineImageId'] = outline_file_id
-        update_data['contourCount'] = sum(len(r.contours) for r in regions)
+        update_data['contourCount'] = summary['contour_count']
     
     databases.update_document(
         database_id='newstitchdb',
@@ -232,15 +256,28 @@ def process_with_phase2(context, storage, databases, project_id, image_np, threa
         'outlineImageId': outline_file_id,
         'extractedColors': color_hex_list,
         'colorCount': len(color_palette),
-        'contourCount': sum(len(r.contours) for r in regions),
+        'contourCount': summary['contour_count'],
         'regionData': region_data,
         'dimensions': dimensions,
         'pipeline': 'phase2'
     }
 
 
+# Preview stroke width (px) per region type; unknown types fall back to 1
+OUTLINE_WIDTHS = {
+    'fill': 2,
+    'outline': 1,
+    'detail': 1,
+}
+
+
 def generate_outline_preview(quantized_image, regions):
-    """Generate a preview image showing extracted contours using PIL."""
+    """
+    Generate a preview image showing extracted contours using PIL.
+    
+    Returns the PIL image itself: it is only ever PNG-encoded, so converting
+    to an array here would just be undone by encode_png.
+    """
     h, w = quantized_image.shape[:2]
     
     outline_pil = Image.new('RGB', (w, h), (255, 255, 255))
@@ -248,32 +285,51 @@ def generate_outline_preview(quantized_image, regions):
     
     for region in regions:
         color = hex_to_rgb(region.color)
+        width = OUTLINE_WIDTHS.get(region.region_type, 1)
         
         for contour in region.contours:
             if len(contour) < 2:
                 continue
             
-            # Convert contour to list of tuples for PIL
-            points = [(int(p[0]), int(p[1])) for p in contour]
-            
-            if region.region_type == 'fill':
-                width = 2
-            elif region.region_type == 'outline':
-                width = 1
-            else:
-                width = 1
+            # Flat [x0, y0, x1, y1, ...] int list for PIL, converted in one
+            # NumPy call rather than building a tuple per point
+            points = np.asarray(contour, dtype=np.int32).ravel().tolist()
             
             # Draw polygon outline
-            if len(points) >= 3:
+            if len(contour) >= 3:
                 draw.polygon(points, outline=color, width=width)
             else:
                 draw.line(points, fill=color, width=width)
     
-    return np.array(outline_pil)
+    return outline_pil
 
 
-def serialize_regions(regions):
+def summarize_regions(regions):
+    """Tally region types, total area and contour count in a single pass."""
+    type_counts = {'fill': 0, 'outline': 0, 'detail': 0}
+    total_area_mm2 = 0.0
+    contour_count = 0
+    
+    for r in regions:
+        type_counts[r.region_type] = type_counts.get(r.region_type, 0) + 1
+        total_area_mm2 += r.area_mm2
+        contour_count += len(r.contours)
+    
+    return {
+        'total_regions': len(regions),
+        'fill_count': type_counts['fill'],
+        'outline_count': type_counts['outline'],
+        'detail_count': type_counts['detail'],
+        'total_area_mm2': round(total_area_mm2, 2),
+        'contour_count': contour_count,
+    }
+
+
+def serialize_regions(regions, summary=None):
     """Convert Region objects to JSON-serializable format."""
+    if summary is None:
+        summary = summarize_regions(regions)
+    
     return {
         'regions': [
             {
@@ -288,11 +344,11 @@ def serialize_regions(regions):
             for r in regions
         ],
         'summary': {
-            'total_regions': len(regions),
-            'fill_count': sum(1 for r in regions if r.region_type == 'fill'),
-            'outline_count': sum(1 for r in regions if r.region_type == 'outline'),
-            'detail_count': sum(1 for r in regions if r.region_type == 'detail'),
-            'total_area_mm2': round(sum(r.area_mm2 for r in regions), 2)
+            'total_regions': summary['total_regions'],
+            'fill_count': summary['fill_count'],
+            'outline_count': summary['outline_count'],
+            'detail_count': summary['detail_count'],
+            'total_area_mm2': summary['total_area_mm2']
         }
     }
 
@@ -301,28 +357,29 @@ def process_legacy(context, storage, databases, project_id, image_np, thread_cou
     """Legacy processing fallback using PIL only."""
     context.log('Using legacy processing...')
     
+    # The legacy path stays in PIL end to end: the image is shrunk to the
+    # safe area, quantized to a palette ('P') image, then pasted onto a 'P'
+    # hoop canvas whose background is one extra white palette entry, so the
+    # PNG is written straight from palette indices with no RGB round trip.
+    
+    # Fit to the hoop safe area first so quantization runs on the final pixels
+    context.log(f'Sizing for {hoop_size} hoop...')
+    working_image = resize_to_working_size(image_np, hoop_size)
+    
     # Quantize colors using PIL
     context.log(f'Quantizing to {thread_count} colors...')
-    quantized_np, colors = quantize_colors_pil(image_np, thread_count)
+    quantized_image, colors = quantize_colors_pil(working_image, thread_count)
     
-    # Resize for hoop
-    context.log(f'Sizing for {hoop_size} hoop...')
-    final_np = resize_for_hoop(quantized_np, hoop_size)
+    # Center on the full hoop canvas (stays palette-mode; RGB only if the palette is full)
+    final_image = resize_for_hoop(quantized_image, hoop_size)
     
     # Save processed image
-    processed_image = Image.fromarray(final_np)
-    buffer = io.BytesIO()
-    processed_image.save(buffer, format='PNG')
-    buffer.seek(0)
+    processed_png = encode_png(final_image)
     
     context.log('Uploading processed image...')
-    processed_file = storage.create_file(
-        bucket_id='project_images',
-        file_id='unique()',
-        file=InputFile.from_bytes(buffer.read(), f'{project_id}_processed.png')
-    )
+    processed_file = upload_png(storage, processed_png, f'{project_id}_processed.png')
     
-    color_hex_list = [rgb_to_hex(c) for c in colors]
+    color_hex_list = palette_to_hex(colors)
     
     context.log('Updating project...')
     databases.update_document(
@@ -347,41 +404,126 @@ def process_legacy(context, storage, databases, project_id, image_np, thread_cou
     }
 
 
-def quantize_colors_pil(image_np, n_colors):
-    """Color quantization using PIL."""
-    image = Image.fromarray(image_np)
-    quantized = image.quantize(colors=n_colors, method=Image.Quantize.MEDIANCUT)
+# Longest side of the subsample the median-cut palette is built from
+PALETTE_SAMPLE_SIZE = 256
+
+
+def quantize_colors_pil(image, n_colors):
+    """
+    Color quantization using PIL (median cut on a subsample, then an undithered remap).
     
-    palette = quantized.getpalette()
-    colors = []
-    for i in range(n_colors):
-        colors.append([palette[i*3], palette[i*3+1], palette[i*3+2]])
+    Returns the palette-mode PIL image and its palette as [r, g, b] lists.
+    """
+    sample = image.copy()
+    sample.thumbnail((PALETTE_SAMPLE_SIZE, PALETTE_SAMPLE_SIZE), Image.Resampling.NEAREST)
+    palette_img = sample.quantize(colors=n_colors, method=Image.Quantize.MEDIANCUT)
+    quantized = image.quantize(palette=palette_img, dither=Image.Dither.NONE)
+    
+    palette = quantized.getpalette()[:n_colors * 3]
+    colors = [palette[i:i + 3] for i in range(0, len(palette), 3)]
     
-    return np.array(quantized.convert('RGB')), colors
+    return quantized, colors
+
 
+# Hoop canvas and safe area sizes in pixels (10 px/mm)
+HOOP_SAFE_AREAS_PX = {'100x100': (900, 900), '70x70': (620, 620)}
+HOOP_FULL_SIZES_PX = {'100x100': (1000, 1000), '70x70': (700, 700)}
 
-def resize_for_hoop(image_np, hoop_size):
-    """Resize image to fit within hoop safe area."""
-    safe_areas = {'100x100': (900, 900), '70x70': (620, 620)}
-    full_sizes = {'100x100': (1000, 1000), '70x70': (700, 700)}
+
+def decode_image(file_data, hoop_size, full_resolution=False):
+    """
+    Decode uploaded bytes into an RGB array.
     
-    safe_size = safe_areas.get(hoop_size, (900, 900))
-    full_size = full_sizes.get(hoop_size, (1000, 1000))
+    For the legacy pipeline, which only ever fits the whole frame to the hoop,
+    JPEGs are decoded at the smallest DCT scale that still covers twice the
+    hoop safe area. full_resolution skips that: the Phase 2 pipeline crops
+    to the subject first, and a small subject needs the original pixels.
+    RGB images skip the convert() copy either way.
+    """
+    safe_w, safe_h = HOOP_SAFE_AREAS_PX.get(hoop_size, HOOP_SAFE_AREAS_PX['100x100'])
+    
+    image = Image.open(io.BytesIO(file_data))
+    if not full_resolution:
+        image.draft('RGB', (2 * safe_w, 2 * safe_h))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    return np.array(image)
+
+
+def resize_to_working_size(image_np, hoop_size):
+    """Downscale image to fit within hoop safe area (no padding); returns a PIL image."""
+    safe_size = HOOP_SAFE_AREAS_PX.get(hoop_size, HOOP_SAFE_AREAS_PX['100x100'])
     
     image = Image.fromarray(image_np)
-    image.thumbnail(safe_size, Image.Resampling.LANCZOS)
+    image.thumbnail(safe_size, Image.Resampling.LANCZOS)  # no-op if it already fits
     
-    canvas = Image.new('RGB', full_size, (255, 255, 255))
-    offset = ((full_size[0] - image.width) // 2, (full_size[1] - image.height) // 2)
-    canvas.paste(image, offset)
+    return image
+
+
+def resize_for_hoop(image, hoop_size):
+    """Fit a PIL image within the hoop safe area, centered on a white full-hoop canvas."""
+    safe_size = HOOP_SAFE_AREAS_PX.get(hoop_size, HOOP_SAFE_AREAS_PX['100x100'])
+    full_size = HOOP_FULL_SIZES_PX.get(hoop_size, HOOP_FULL_SIZES_PX['100x100'])
+    
+    if image.width > safe_size[0] or image.height > safe_size[1]:
+        image = image.convert('RGB')
+        image.thumbnail(safe_size, Image.Resampling.LANCZOS)
+    
+    palette = image.getpalette() if image.mode == 'P' else None
+    if palette is not None and len(palette) < 256 * 3:
+        # Keep it a palette image: fill the canvas with an extra white entry
+        canvas = Image.new('P', full_size, len(palette) // 3)
+        canvas.putpalette(palette + [255, 255, 255])
+    else:
+        canvas = Image.new('RGB', full_size, (255, 255, 255))
+        image = image.convert('RGB')
+    
+    left = (full_size[0] - image.width) // 2
+    top = (full_size[1] - image.height) // 2
+    canvas.paste(image, (left, top))
+    
+    return canvas
+
+
+def encode_png(image_np):
+    """
+    Encode an RGB array (or an already-built PIL image) as PNG bytes.
     
-    return np.array(canvas)
+    Uses zlib level 1: our outputs are flat palette images, which compress
+    almost as well at level 1 as at PIL's default of 6, in a fraction of the time.
+    """
+    buffer = io.BytesIO()
+    image = image_np if isinstance(image_np, Image.Image) else Image.fromarray(image_np)
+    image.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+def encode_and_upload(storage, image, filename):
+    """Encode an image as PNG and upload it (one unit of work for a pool thread)."""
+    return upload_png(storage, encode_png(image), filename)
+
+
+def upload_png(storage, png_bytes, filename):
+    """Upload PNG bytes to the project images bucket."""
+    return storage.create_file(
+        bucket_id='project_images',
+        file_id='unique()',
+        file=InputFile.from_bytes(png_bytes, filename)
+    )
+
+
+# Two-digit lowercase hex for every byte value
+HEX_BYTES = tuple(f'{i:02x}' for i in range(256))
 
 
-def rgb_to_hex(rgb):
-    return '#{:02x}{:02x}{:02x}'.format(int(rgb[0]), int(rgb[1]), int(rgb[2]))
+def palette_to_hex(colors):
+    """Convert a list of RGB triples to hex strings via the HEX_BYTES table (one cast for all colors)."""
+    if len(colors) == 0:
+        return []
+    rgb = np.asarray(colors, dtype=np.uint8).reshape(-1, 3).tolist()
+    return ['#' + HEX_BYTES[r] + HEX_BYTES[g] + HEX_BYTES[b] for r, g, b in rgb]
 
 
 def hex_to_rgb(hex_color):
-    hex_color = hex_color.lstrip('#')
-    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+    return tuple(bytes.fromhex(hex_color.lstrip('#')[:6]))
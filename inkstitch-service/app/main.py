@@ -9,18 +9,34 @@
 
 import io
 import os
+import asyncio
+import hashlib
+import time
+import runpy
 import sys
 import json
 import shutil
+import signal
 import subprocess
 import tempfile
 import zipfile
 import logging
-from typing import Optional
+import multiprocessing
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from types import MappingProxyType
+from typing import IO, Mapping, Optional, Union
 
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.responses import Response, StreamingResponse
 import numpy as np
+import pyembroidery
 from PIL import Image
 
 logger = logging.getLogger("inkstitch_api")
@@ -34,6 +50,37 @@ INKSTITCH_BIN = os.path.join(INKSTITCH_DIR, "inkstitch.py")  # Python entry poin
 INKSCAPE_BIN = shutil.which("inkscape") or "inkscape"
 POTRACE_BIN = "potrace"
 
+# Live potrace processes allowed at once, shared by all requests
+POTRACE_CONCURRENCY = os.cpu_count() or 1
+
+# Per-request scratch dirs; None = the system temp dir. Point this at a
+# tmpfs (e.g. /dev/shm, sized with shm_size in docker-compose) to keep the
+# SVG/zip round-trips off disk
+WORK_DIR = os.environ.get("INKSTITCH_WORK_DIR") or None
+
+# Colors covering less than this many mm² in total are speckle: not worth a
+# potrace run, and too small for Ink/Stitch to fill anyway
+MIN_COLOR_AREA_MM2 = 1.0
+
+# Long-lived Ink/Stitch worker processes. Opt-in (0 = always fork the CLI):
+# the in-process export has not been checked against the image's real
+# Ink/Stitch install yet
+INKSTITCH_WORKERS = int(os.environ.get("INKSTITCH_WORKERS", "0"))
+# Total budget for the whole export chain (worker, CLI, Inkscape), kept under
+# generate-pes's 120 s request timeout
+INKSTITCH_TIMEOUT = 100
+INKSTITCH_WORKER_SLOTS = threading.BoundedSemaphore(max(INKSTITCH_WORKERS, 1))
+
+# Ink/Stitch output cached by SVG content hash (retries, re-exports of the
+# same design); 0 disables
+PES_CACHE_SIZE = int(os.environ.get("PES_CACHE_SIZE", "32"))
+
+# Numbers in SVG path data (used by the pyembroidery fallback)
+PATH_NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)')
+
+# d attributes in potrace's SVG output, which is machine-generated and flat
+POTRACE_PATH_RE = re.compile(rb'<path\b[^>]*?\sd="([^"]*)"')
+
 # Hoop safe areas in mm (slightly inset from full hoop)
 HOOP_SAFE = {
     "100x100": (90, 90),
@@ -76,6 +123,14 @@ QUALITY_PRESETS = {
 }
 
 
+@app.on_event("startup")
+def warm_inkstitch_pool():
+    """Start the Ink/Stitch workers up front so the first request doesn't pay the imports."""
+    pool = get_inkstitch_pool()
+    if pool is not None:
+        pool.submit(os.getpid)
+
+
 @app.get("/health")
 def health():
     inkstitch_ok = os.path.isdir(INKSTITCH_DIR)
@@ -108,12 +163,13 @@ async def image_to_pes(
         thread_colors: JSON array of hex colors for thread order, e.g. '["#FF0000","#00FF00"]'
         density_override: Override row spacing (mm), lower = denser
     """
-    tmpdir = tempfile.mkdtemp(prefix="inkstitch_")
+    tmpdir = tempfile.mkdtemp(prefix="inkstitch_", dir=WORK_DIR)
     try:
         # 1. Load and preprocess image with Pillow
         logger.info("Step 1: Loading image...")
-        raw = await file.read()
-        img = Image.open(io.BytesIO(raw)).convert("RGBA")
+        # Decode straight from the spooled upload rather than a bytes copy
+        await file.seek(0)
+        img = Image.open(file.file)
         
         # Parse thread colors if provided
         colors = None
@@ -131,40 +187,52 @@ async def image_to_pes(
         target_w = safe_w * px_per_mm
         target_h = safe_h * px_per_mm
         
-        # Maintain aspect ratio
+        # Maintain aspect ratio (size comes from the header, nothing decoded yet)
         ratio = min(target_w / img.width, target_h / img.height)
         new_w = int(img.width * ratio)
         new_h = int(img.height * ratio)
-        img = img.resize((new_w, new_h), Image.LANCZOS)
+        
+        # JPEG: have libjpeg decode at the smallest DCT scale (1/2..1/8) that
+        # still covers the output size; no-op for other formats
+        img.draft("RGB", (new_w, new_h))
+        
+        # Only carry an alpha channel when the source has one
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+        work_mode = "RGBA" if has_alpha else "RGB"
+        if img.mode != work_mode:
+            img = img.convert(work_mode)
+        # Within a pixel of the target already: keep it rather than
+        # resampling the whole image for a one-pixel change
+        if abs(img.width - new_w) <= 1 and abs(img.height - new_h) <= 1:
+            new_w, new_h = img.size
+        else:
+            # reducing_gap: big downscales box-reduce first, then LANCZOS
+            img = img.resize((new_w, new_h), Image.LANCZOS, reducing_gap=3.0)
         
         logger.info(f"  Resized to {new_w}x{new_h} px (hoop: {safe_w}x{safe_h} mm)")
         
         # 2. Extract unique colors (image should already be quantized)
         logger.info("Step 2: Extracting color regions...")
-        img_rgb = img.convert("RGB")
-        arr = np.array(img_rgb)
+        pixels = np.asarray(img)
+        arr = pixels[..., :3]
         
-        # Also get alpha for background masking
-        alpha = np.array(img.split()[-1]) if img.mode == "RGBA" else np.full(arr.shape[:2], 255, dtype=np.uint8)
-        
-        # Find unique non-background colors
-        mask_fg = alpha > 128  # foreground pixels
-        fg_pixels = arr[mask_fg]
+        # Find unique non-background colors (alpha, if any, masks the background)
+        if has_alpha:
+            mask_fg = pixels[..., 3] > 128  # foreground pixels
+        else:
+            mask_fg = np.ones(arr.shape[:2], dtype=bool)
         
-        if len(fg_pixels) == 0:
+        if not mask_fg.any():
             raise HTTPException(status_code=400, detail="Image has no foreground pixels")
         
-        unique_colors = np.unique(fg_pixels.reshape(-1, 3), axis=0)
+        # One pass gives the colors, a per-pixel color label and per-color areas
+        unique_colors, labels, counts = color_label_map(arr, mask_fg)
         logger.info(f"  Found {len(unique_colors)} unique colors")
         
         # If too many colors, quantize
         if len(unique_colors) > 20:
             logger.info("  Too many colors, quantizing to 8...")
-            img_q = img_rgb.quantize(colors=8, method=Image.Quantize.MEDIANCUT)
-            img_rgb = img_q.convert("RGB")
-            arr = np.array(img_rgb)
-            fg_pixels = arr[mask_fg]
-            unique_colors = np.unique(fg_pixels.reshape(-1, 3), axis=0)
+            unique_colors, labels, counts = quantize_label_map(unique_colors, labels, counts, 8)
             logger.info(f"  After quantization: {len(unique_colors)} colors")
         
         # Order colors by thread_colors if provided, otherwise by area (largest first)
@@ -173,46 +241,29 @@ async def image_to_pes(
             ordered = order_colors_by_mapping(unique_colors, colors)
         else:
             # Sort by area (most pixels first) 
-            ordered = sort_colors_by_area(arr, unique_colors, mask_fg)
+            ordered = sort_colors_by_area(unique_colors, counts)
         
-        # 3. Vectorize each color region with potrace
+        label_of = {tuple(c): k for k, c in enumerate(unique_colors.tolist())}
+        
+        # 3. Vectorize each color region with potrace (one subprocess per
+        # color, piped through stdin/stdout, run concurrently on worker
+        # threads, at most one per core across all requests)
         logger.info("Step 3: Vectorizing regions...")
-        svg_paths = []
-        
-        for i, color_rgb in enumerate(ordered):
-            hex_color = "#{:02X}{:02X}{:02X}".format(*color_rgb)
-            logger.info(f"  Vectorizing color {i+1}/{len(ordered)}: {hex_color}")
-            
-            # Create binary mask for this color
-            color_mask = np.all(arr == color_rgb, axis=2) & mask_fg
-            
-            if not np.any(color_mask):
-                continue
-            
-            # Save as PBM for potrace
-            pbm_path = os.path.join(tmpdir, f"color_{i}.pbm")
-            svg_path = os.path.join(tmpdir, f"color_{i}.svg")
-            
-            save_mask_as_pbm(color_mask, pbm_path)
-            
-            # Run potrace to get SVG path
-            result = subprocess.run(
-                [POTRACE_BIN, "-s", "--flat", "-o", svg_path, pbm_path],
-                capture_output=True, text=True, timeout=30
-            )
-            
-            if result.returncode != 0:
-                logger.warning(f"  potrace failed for color {hex_color}: {result.stderr}")
-                continue
-            
-            # Extract path data from potrace SVG output
-            path_data = extract_potrace_paths(svg_path)
-            if path_data:
-                svg_paths.append({
-                    "color": hex_color,
-                    "paths": path_data,
-                    "index": i,
-                })
+        
+        async def vectorize(i, color_rgb):
+            async with potrace_slots():
+                return await asyncio.to_thread(
+                    vectorize_color, i, len(ordered), color_rgb,
+                    labels, label_of[tuple(color_rgb.tolist())],
+                )
+        
+        # Colors below MIN_COLOR_AREA_MM2 never reach potrace
+        min_px = int(MIN_COLOR_AREA_MM2 * px_per_mm ** 2)
+        results = await asyncio.gather(
+            *(vectorize(i, color_rgb) for i, color_rgb in enumerate(ordered)
+              if counts[label_of[tuple(color_rgb.tolist())]] >= min_px)
+        )
+        svg_paths = [r for r in results if r]
         
         if not svg_paths:
             raise HTTPException(status_code=400, detail="No regions could be vectorized")
@@ -223,26 +274,22 @@ async def image_to_pes(
         logger.info("Step 4: Building SVG with stitch parameters...")
         
         # Get quality preset params
-        preset_params = dict(DEFAULT_FILL_PARAMS)
-        if quality in QUALITY_PRESETS:
-            preset_params.update(QUALITY_PRESETS[quality])
+        preset_params = quality_params(quality)
         
         # Apply density override
         if density_override and density_override > 0:
-            preset_params["inkstitch:row_spacing_mm"] = str(density_override)
-        
-        svg_content = build_inkstitch_svg(
-            svg_paths, new_w, new_h, px_per_mm, preset_params
-        )
+            preset_params = {**preset_params, "inkstitch:row_spacing_mm": str(density_override)}
         
         svg_file = os.path.join(tmpdir, "design.svg")
-        with open(svg_file, "w") as f:
-            f.write(svg_content)
+        write_inkstitch_svg(
+            svg_file, svg_paths, new_w, new_h, px_per_mm, preset_params
+        )
         
         # 5. Run Ink/Stitch to generate PES
         logger.info("Step 5: Generating PES with Ink/Stitch...")
         
-        pes_bytes = run_inkstitch_export(svg_file, tmpdir)
+        # Off the event loop: the export can take up to two minutes
+        pes_bytes = await asyncio.to_thread(run_inkstitch_export, svg_file, tmpdir)
         
         logger.info(f"  PES generated: {len(pes_bytes)} bytes")
         
@@ -260,7 +307,7 @@ async def image_to_pes(
         logger.exception("Processing error")
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        await asyncio.to_thread(shutil.rmtree, tmpdir, ignore_errors=True)
 
 
 @app.post("/svg-to-pes")
@@ -272,14 +319,14 @@ async def svg_to_pes(
     Convert SVG (with inkstitch attributes already set) directly to PES.
     Use this if you build the SVG yourself and just need Ink/Stitch to generate stitches.
     """
-    tmpdir = tempfile.mkdtemp(prefix="inkstitch_")
+    tmpdir = tempfile.mkdtemp(prefix="inkstitch_", dir=WORK_DIR)
     try:
-        svg_data = await file.read()
         svg_file = os.path.join(tmpdir, "input.svg")
+        await file.seek(0)
         with open(svg_file, "wb") as f:
-            f.write(svg_data)
+            shutil.copyfileobj(file.file, f, 1 << 20)
         
-        pes_bytes = run_inkstitch_export(svg_file, tmpdir)
+        pes_bytes = await asyncio.to_thread(run_inkstitch_export, svg_file, tmpdir)
         
         return Response(
             content=pes_bytes,
@@ -291,7 +338,7 @@ async def svg_to_pes(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        await asyncio.to_thread(shutil.rmtree, tmpdir, ignore_errors=True)
 
 
 @app.post("/resize-or-convert")
@@ -301,17 +348,15 @@ async def resize_or_convert(
     scale: float = Form(1.0),
 ):
     """Resize or convert existing embroidery files using pyembroidery."""
-    from pyembroidery import read as emb_read, write as emb_write
-    
-    tmpdir = tempfile.mkdtemp(prefix="inkstitch_")
+    tmpdir = tempfile.mkdtemp(prefix="inkstitch_", dir=WORK_DIR)
     try:
-        raw = await file.read()
         suffix = os.path.splitext(file.filename or "input.pes")[1]
         in_path = os.path.join(tmpdir, f"input{suffix}")
+        await file.seek(0)
         with open(in_path, "wb") as f:
-            f.write(raw)
+            shutil.copyfileobj(file.file, f, 1 << 20)
         
-        pattern = emb_read(in_path)
+        pattern = pyembroidery.read(in_path)
         if pattern is None:
             raise HTTPException(status_code=400, detail="Could not read embroidery file")
         
@@ -319,7 +364,7 @@ async def resize_or_convert(
             pattern.scale(scale, scale)
         
         out_path = os.path.join(tmpdir, f"output.{target_format.lower()}")
-        emb_write(pattern, out_path)
+        pyembroidery.write(pattern, out_path)
         
         with open(out_path, "rb") as f:
             out_bytes = f.read()
@@ -336,7 +381,7 @@ async def resize_or_convert(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Conversion error: {str(e)}")
     finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+        await asyncio.to_thread(shutil.rmtree, tmpdir, ignore_errors=True)
 
 
 # ─── Ink/Stitch export helper ────────────────────────────────────────
@@ -349,42 +394,103 @@ def run_inkstitch_export(svg_file: str, tmpdir: str) -> bytes:
     1. inkstitch.py direct CLI (if available)
     2. Inkscape with Ink/Stitch extension actions
     3. Fallback: pyembroidery from SVG paths (basic fill)
+    
+    Approaches 1 and 2 share one INKSTITCH_TIMEOUT deadline, so a slow
+    attempt leaves less time for the next rather than each getting its own.
+    Results from approaches 1 and 2 are cached by SVG content, so an
+    identical design skips Ink/Stitch entirely.
     """
     
+    with open(svg_file, "rb") as f:
+        cache_key = hashlib.blake2b(f.read(), digest_size=16).digest()
+    cached = pes_cache_get(cache_key)
+    if cached is not None:
+        logger.info(f"  PES cache hit: {len(cached)} bytes")
+        return cached
+    
+    deadline = time.monotonic() + INKSTITCH_TIMEOUT
+    
+    def time_left():
+        return max(0.0, deadline - time.monotonic())
+    
     # Approach 1: Try inkstitch.py directly
     if os.path.isfile(INKSTITCH_BIN):
+        # The zip goes straight into a file; only the .pes member is ever
+        # read back into memory
+        
+        # 1a: in a warm worker that already has Ink/Stitch's imports loaded.
+        # Only when a worker is free right now: queueing behind other exports
+        # would eat into the timeout, so busy pools go straight to 1b
+        pool = get_inkstitch_pool()
+        if pool is not None and INKSTITCH_WORKER_SLOTS.acquire(blocking=False):
+            worker_zip = os.path.join(tmpdir, "inkstitch_worker.zip")
+            future = None
+            try:
+                logger.info("  Trying warm Ink/Stitch worker...")
+                future = pool.submit(
+                    inkstitch_zip_in_process, svg_file, worker_zip, time_left()
+                )
+                if future.result(timeout=time_left()):
+                    with open(worker_zip, "rb") as zip_in:
+                        pes = extract_pes_from_zip(zip_in)
+                    if pes:
+                        logger.info(f"  Ink/Stitch worker succeeded: {len(pes)} bytes")
+                        pes_cache_put(cache_key, pes)
+                        return pes
+                logger.warning("  Ink/Stitch worker produced no PES")
+            except Exception as e:
+                logger.warning(f"  Ink/Stitch worker error: {e!r}")
+                if isinstance(e, (FuturesTimeoutError, BrokenProcessPool)):
+                    # Don't hand later requests a pool with a hung or dead
+                    # worker in it; the next get_inkstitch_pool() starts fresh
+                    if future is not None:
+                        future.cancel()
+                    reset_inkstitch_pool(pool)
+            finally:
+                INKSTITCH_WORKER_SLOTS.release()
+        
+        # 1b: a fresh inkstitch.py process
         try:
+            if time_left() == 0:
+                raise subprocess.TimeoutExpired("inkstitch.py", INKSTITCH_TIMEOUT)
             logger.info("  Trying inkstitch.py CLI...")
-            result = subprocess.run(
-                [sys.executable, INKSTITCH_BIN, "--extension=zip",
-                 "--format-pes=True", svg_file],
-                capture_output=True, timeout=120,
-                env={**os.environ, "PYTHONPATH": INKSTITCH_DIR}
-            )
-            if result.returncode == 0 and result.stdout:
-                pes = extract_pes_from_zip(result.stdout)
-                if pes:
-                    logger.info(f"  inkstitch.py succeeded: {len(pes)} bytes")
-                    return pes
+            zip_path = os.path.join(tmpdir, "inkstitch_output.zip")
+            with open(zip_path, "w+b") as zip_out:
+                result = subprocess.run(
+                    [sys.executable, INKSTITCH_BIN, "--extension=zip",
+                     "--format-pes=True", svg_file],
+                    stdout=zip_out, stderr=subprocess.PIPE, timeout=time_left(),
+                    env={**os.environ, "PYTHONPATH": INKSTITCH_DIR}
+                )
+                if result.returncode == 0 and zip_out.tell() > 0:
+                    zip_out.seek(0)
+                    pes = extract_pes_from_zip(zip_out)
+                    if pes:
+                        logger.info(f"  inkstitch.py succeeded: {len(pes)} bytes")
+                        pes_cache_put(cache_key, pes)
+                        return pes
             logger.warning(f"  inkstitch.py failed: {result.stderr[:300]}")
         except Exception as e:
             logger.warning(f"  inkstitch.py error: {e}")
     
     # Approach 2: Inkscape CLI with extension
     try:
+        if time_left() == 0:
+            raise subprocess.TimeoutExpired("inkscape", INKSTITCH_TIMEOUT)
         logger.info("  Trying Inkscape + Ink/Stitch extension...")
         pes_file = os.path.join(tmpdir, "output.pes")
         result = subprocess.run(
             [INKSCAPE_BIN, svg_file,
              "--actions=select-all;org.inkstitch.output_pes",
              f"--export-filename={pes_file}"],
-            capture_output=True, text=True, timeout=120,
+            capture_output=True, text=True, timeout=time_left(),
             env={**os.environ, "DISPLAY": "", "HOME": "/root"}
         )
         if os.path.isfile(pes_file) and os.path.getsize(pes_file) > 0:
             with open(pes_file, "rb") as f:
                 pes = f.read()
             logger.info(f"  Inkscape export succeeded: {len(pes)} bytes")
+            pes_cache_put(cache_key, pes)
             return pes
         logger.warning(f"  Inkscape export failed: {result.stderr[:300]}")
     except Exception as e:
@@ -395,17 +501,146 @@ def run_inkstitch_export(svg_file: str, tmpdir: str) -> bytes:
     return pyembroidery_fallback(svg_file, tmpdir)
 
 
+_PES_CACHE: "OrderedDict[bytes, bytes]" = OrderedDict()
+_PES_CACHE_LOCK = threading.Lock()
+
+
+def pes_cache_get(key: bytes) -> Optional[bytes]:
+    """Look up cached PES bytes for an SVG hash, marking the entry as recently used."""
+    with _PES_CACHE_LOCK:
+        pes = _PES_CACHE.get(key)
+        if pes is not None:
+            _PES_CACHE.move_to_end(key)
+        return pes
+
+
+def pes_cache_put(key: bytes, pes: bytes):
+    """Store PES bytes for an SVG hash, evicting the least recently used entries."""
+    if PES_CACHE_SIZE <= 0:
+        return
+    with _PES_CACHE_LOCK:
+        _PES_CACHE[key] = pes
+        _PES_CACHE.move_to_end(key)
+        while len(_PES_CACHE) > PES_CACHE_SIZE:
+            _PES_CACHE.popitem(last=False)
+
+
+_INKSTITCH_POOL: Optional[ProcessPoolExecutor] = None
+_INKSTITCH_POOL_LOCK = threading.Lock()
+
+
+def get_inkstitch_pool() -> Optional[ProcessPoolExecutor]:
+    """Process pool whose workers keep Ink/Stitch and its dependencies imported."""
+    global _INKSTITCH_POOL
+    
+    if INKSTITCH_WORKERS <= 0 or not os.path.isfile(INKSTITCH_BIN):
+        return None
+    with _INKSTITCH_POOL_LOCK:
+        if _INKSTITCH_POOL is None:
+            # spawn rather than fork: the API process is threaded by the time
+            # the first request arrives
+            _INKSTITCH_POOL = ProcessPoolExecutor(
+                max_workers=INKSTITCH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=preimport_inkstitch,
+            )
+        return _INKSTITCH_POOL
+
+
+def reset_inkstitch_pool(pool: ProcessPoolExecutor):
+    """
+    Retire a pool with a hung or dead worker: drop it so the next
+    get_inkstitch_pool() creates a fresh one, and shut it down with its
+    queued jobs cancelled. A job already running stops at its own SIGALRM
+    deadline (see inkstitch_zip_in_process), or is killed outright where the
+    runtime offers it (Python 3.14+ kill_workers).
+    """
+    global _INKSTITCH_POOL
+    
+    with _INKSTITCH_POOL_LOCK:
+        if _INKSTITCH_POOL is pool:
+            _INKSTITCH_POOL = None
+    
+    kill_workers = getattr(pool, "kill_workers", None)
+    if kill_workers is not None:
+        kill_workers()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def preimport_inkstitch():
+    """Worker initializer: load the heavy modules every export would otherwise re-import."""
+    if INKSTITCH_DIR not in sys.path:
+        sys.path.insert(0, INKSTITCH_DIR)
+    for module in ("lxml.etree", "shapely.geometry", "networkx", "pyembroidery", "inkex", "lib"):
+        try:
+            __import__(module)
+        except Exception:
+            pass
+
+
+class InkstitchWorkerTimeout(Exception):
+    """Raised inside a worker when an in-process export overruns its budget."""
+
+
+def inkstitch_zip_in_process(svg_file: str, zip_path: str, timeout: float) -> bool:
+    """
+    Run inkstitch.py's zip extension inside the current (worker) process,
+    with its stdout pointed at zip_path. Returns True if a zip was written.
+    
+    A SIGALRM stops the export after timeout seconds, so a hung design frees
+    its worker instead of pinning it (pool tasks run on the worker's main
+    thread, where signal handlers fire).
+    
+    Only exercised against a stand-in inkstitch.py that writes its zip to
+    sys.stdout.buffer (as inkex output does), not a real Ink/Stitch install.
+    Anything that writes to fd 1 directly would bypass the swap and leave an
+    empty zip, which the caller treats as a failure and falls back to the CLI.
+    """
+    def on_alarm(signum, frame):
+        raise InkstitchWorkerTimeout(f"export exceeded {timeout:.0f} s")
+    
+    saved_argv, saved_stdout = sys.argv, sys.stdout
+    saved_handler = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, max(timeout, 0.01))
+    with open(zip_path, "wb") as zip_out:
+        stdout = io.TextIOWrapper(zip_out, write_through=True)
+        sys.argv = [INKSTITCH_BIN, "--extension=zip", "--format-pes=True", svg_file]
+        sys.stdout = stdout
+        try:
+            runpy.run_path(INKSTITCH_BIN, run_name="__main__")
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                return False
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, saved_handler)
+            sys.argv, sys.stdout = saved_argv, saved_stdout
+            stdout.flush()
+            stdout.detach()
+        return zip_out.tell() > 0
+
+
 def pyembroidery_fallback(svg_file: str, tmpdir: str) -> bytes:
     """
     Basic PES generation using pyembroidery when Ink/Stitch isn't working.
     Parses SVG paths, generates simple fill stitches.
     """
-    import pyembroidery
     import xml.etree.ElementTree as ET
     
-    tree = ET.parse(svg_file)
-    root = tree.getroot()
-    ns = {"svg": "http://www.w3.org/2000/svg"}
+    # Stream the SVG: keep the root's attributes and each path's style/d,
+    # clearing elements as they complete so the tree is never held whole
+    root = None
+    svg_paths, bare_paths = [], []
+    for event, el in ET.iterparse(svg_file, events=("start", "end")):
+        if root is None:
+            root = el
+        elif event == "end":
+            if el.tag == "{http://www.w3.org/2000/svg}path":
+                svg_paths.append((el.get("style", ""), el.get("d", "")))
+            elif el.tag == "path":
+                bare_paths.append((el.get("style", ""), el.get("d", "")))
+            if el is not root:
+                el.clear()
     
     # Get viewBox dimensions
     vb = root.get("viewBox", "0 0 100 100").split()
@@ -424,14 +659,13 @@ def pyembroidery_fallback(svg_file: str, tmpdir: str) -> bytes:
     pattern = pyembroidery.EmbPattern()
     
     # Find all paths with fill colors
-    paths = root.findall(".//svg:path", ns) or root.findall(".//path")
+    paths = svg_paths or bare_paths
     
     if not paths:
         raise HTTPException(status_code=400, detail="No paths found in SVG")
     
     color_count = 0
-    for path_el in paths:
-        style = path_el.get("style", "")
+    for style, d in paths:
         fill_color = None
         for part in style.split(";"):
             if part.strip().startswith("fill:"):
@@ -459,42 +693,26 @@ def pyembroidery_fallback(svg_file: str, tmpdir: str) -> bytes:
         
         # Simple bounding box fill (since parsing SVG path data is complex)
         # Get a rough bounding box from the path data
-        d = path_el.get("d", "")
         coords = extract_coords_from_path(d)
         
-        if not coords:
+        if len(coords) == 0:
+            continue
+        
+        min_x, min_y = coords.min(axis=0)
+        max_x, max_y = coords.max(axis=0)
+        
+        # Generate fill stitches (zigzag rows), all coordinates at once
+        ex, ey = zigzag_fill(
+            min_x, max_x, min_y, max_y,
+            origin=(vb_w / 2, vb_h / 2), scale=(scale_x, scale_y),
+            row_spacing=3, stitch_len=30,  # pixels
+        )
+        if len(ex) == 0:
             continue
         
-        xs = [c[0] for c in coords]
-        ys = [c[1] for c in coords]
-        min_x, max_x = min(xs), max(xs)
-        min_y, max_y = min(ys), max(ys)
-        
-        # Generate fill stitches (zigzag rows)
-        row_spacing = 3  # pixels
-        stitch_len = 30  # pixels
-        first = True
-        direction = 1
-        
-        y = min_y
-        while y <= max_y:
-            if direction == 1:
-                x_range = range(int(min_x), int(max_x) + 1, stitch_len)
-            else:
-                x_range = range(int(max_x), int(min_x) - 1, -stitch_len)
-            
-            for x in x_range:
-                ex = int((x - vb_w / 2) * scale_x)
-                ey = int((y - vb_h / 2) * scale_y)
-                
-                if first:
-                    pattern.add_stitch_absolute(pyembroidery.JUMP, ex, ey)
-                    first = False
-                else:
-                    pattern.add_stitch_absolute(pyembroidery.STITCH, ex, ey)
-            
-            y += row_spacing
-            direction *= -1
+        pattern.add_stitch_absolute(pyembroidery.JUMP, ex[0], ey[0])
+        for x, y in zip(ex[1:], ey[1:]):
+            pattern.add_stitch_absolute(pyembroidery.STITCH, x, y)
     
     pattern.end()
     
@@ -510,41 +728,162 @@ def pyembroidery_fallback(svg_file: str, tmpdir: str) -> bytes:
     return pes_data
 
 
-def extract_coords_from_path(d: str) -> list:
-    """Extract approximate coordinates from SVG path data."""
-    import re
-    coords = []
-    # Find all number pairs in the path data
-    numbers = re.findall(r'[-+]?(?:\d+\.?\d*|\.\d+)', d)
-    for i in range(0, len(numbers) - 1, 2):
-        try:
-            coords.append((float(numbers[i]), float(numbers[i + 1])))
-        except (ValueError, IndexError):
-            pass
-    return coords
+def zigzag_fill(
+    min_x: float,
+    max_x: float,
+    min_y: float,
+    max_y: float,
+    origin: tuple[float, float],
+    scale: tuple[float, float],
+    row_spacing: int,
+    stitch_len: int,
+) -> tuple[list[int], list[int]]:
+    """
+    Boustrophedon stitch coordinates covering a bounding box, in embroidery units.
+    
+    Rows run every row_spacing pixels from min_y, alternating left→right
+    (from int(min_x)) and right→left (from int(max_x)), with a stitch every
+    stitch_len pixels. Pixel coordinates are shifted by origin, scaled and
+    truncated to ints.
+    """
+    n_rows = int((max_y - min_y) // row_spacing) + 1
+    forward = np.arange(int(min_x), int(max_x) + 1, stitch_len)
+    backward = np.arange(int(max_x), int(min_x) - 1, -stitch_len)
+    
+    # One forward + backward pair repeated, plus a trailing forward row
+    pair = np.concatenate([forward, backward])
+    xs = np.concatenate([np.tile(pair, n_rows // 2), forward[:len(forward) * (n_rows % 2)]])
+    row_lengths = np.tile([len(forward), len(backward)], n_rows // 2 + 1)[:n_rows]
+    ys = np.repeat(min_y + row_spacing * np.arange(n_rows), row_lengths)
+    
+    ex = ((xs - origin[0]) * scale[0]).astype(np.int64)
+    ey = ((ys - origin[1]) * scale[1]).astype(np.int64)
+    return ex.tolist(), ey.tolist()
+
+
+def extract_coords_from_path(d: str) -> np.ndarray:
+    """Extract approximate coordinates from SVG path data as an (N, 2) array."""
+    # Find all number pairs in the path data (a trailing odd number is dropped)
+    numbers = PATH_NUMBER_RE.findall(d)
+    coords = np.array(numbers[:len(numbers) & ~1], dtype=np.float64)
+    return coords.reshape(-1, 2)
 
 
 # ─── Helper functions ───────────────────────────────────────────────
 
-def save_mask_as_pbm(mask: np.ndarray, path: str):
-    """Save a boolean mask as PBM (portable bitmap) for potrace."""
+_POTRACE_SLOTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def potrace_slots() -> asyncio.Semaphore:
+    """
+    The potrace limiter for the running event loop, created on first use.
+    
+    One semaphore per loop rather than a module-level one: an asyncio
+    semaphore that has been waited on stays bound to that loop, and a
+    later loop (test client, reload) would fail using it.
+    """
+    loop = asyncio.get_running_loop()
+    slots = _POTRACE_SLOTS.get(loop)
+    if slots is None:
+        slots = _POTRACE_SLOTS[loop] = asyncio.Semaphore(POTRACE_CONCURRENCY)
+    return slots
+
+
+@lru_cache(maxsize=8)
+def quality_params(quality: str) -> Mapping[str, str]:
+    """Default fill params merged with a quality preset (read-only, cached per preset)."""
+    params = dict(DEFAULT_FILL_PARAMS)
+    params.update(QUALITY_PRESETS.get(quality, {}))
+    return MappingProxyType(params)
+
+
+@lru_cache(maxsize=32)
+def param_attrs_string(items: tuple[tuple[str, str], ...]) -> str:
+    """SVG attribute text for a set of stitch params (cached; presets repeat across requests)."""
+    return " ".join(f'{k}="{v}"' for k, v in items)
+
+
+def vectorize_color(
+    i: int,
+    n_colors: int,
+    color_rgb: np.ndarray,
+    labels: np.ndarray,
+    label: int,
+) -> Optional[dict]:
+    """Trace one color's mask with potrace; returns its svg_paths entry or None."""
+    hex_color = "#{:02X}{:02X}{:02X}".format(*color_rgb)
+    logger.info(f"  Vectorizing color {i+1}/{n_colors}: {hex_color}")
+    
+    # Binary mask for this color (background has its own label), written
+    # into this worker thread's reusable buffer
+    color_mask = np.equal(labels, label, out=mask_buffer(labels.shape))
+    
+    if not np.any(color_mask):
+        return None
+    
+    # Run potrace to get SVG path: PBM in on stdin, SVG out on stdout,
+    # so nothing touches the filesystem
+    result = subprocess.run(
+        [POTRACE_BIN, "-s", "--flat", "-o", "-", "-"],
+        input=mask_to_pbm(color_mask), capture_output=True, timeout=30
+    )
+    
+    if result.returncode != 0:
+        logger.warning(f"  potrace failed for color {hex_color}: {result.stderr.decode(errors='replace')}")
+        return None
+    
+    # Extract path data from potrace SVG output
+    path_data = extract_potrace_paths(result.stdout)
+    if not path_data:
+        return None
+    
+    return {
+        "color": hex_color,
+        "paths": path_data,
+        "index": i,
+    }
+
+
+_MASK_BUFFERS = threading.local()
+
+
+def mask_buffer(shape: tuple[int, int]) -> np.ndarray:
+    """Per-thread bool scratch array for color masks, reallocated only when the shape changes."""
+    buf = getattr(_MASK_BUFFERS, "mask", None)
+    if buf is None or buf.shape != shape:
+        buf = _MASK_BUFFERS.mask = np.empty(shape, dtype=bool)
+    return buf
+
+
+def mask_to_pbm(mask: np.ndarray) -> bytes:
+    """Encode a boolean mask as PBM (portable bitmap) for potrace."""
     h, w = mask.shape
-    # PBM: P1 format (ASCII), 1 = black, 0 = white
-    # Potrace traces black pixels, so invert: foreground (True) → 1
-    with open(path, "w") as f:
-        f.write(f"P1\n{w} {h}\n")
-        for row in mask:
-            f.write(" ".join("1" if px else "0" for px in row) + "\n")
+    # PBM: P4 format (binary), 1 = black, 0 = white
+    # Potrace traces black pixels, so foreground (True) → 1
+    # P4 packs 8 pixels per byte MSB-first, each row padded to a whole byte,
+    # which is exactly what np.packbits along rows produces
+    packed = np.packbits(mask, axis=1)
+    return f"P4\n{w} {h}\n".encode("ascii") + packed.tobytes()
 
 
-def extract_potrace_paths(svg_path: str) -> list[str]:
+def extract_potrace_paths(svg_data: bytes) -> list[str]:
     """Extract SVG path 'd' attributes from potrace SVG output."""
+    # An empty or speckle-only trace has no paths at all; nothing to parse
+    if b"<path" not in svg_data:
+        return []
+    
+    # Potrace always writes d="..." on plain <path> elements, so a regex scan
+    # finds them without building a tree; XML parsing is only the fallback
+    paths = [m.decode("ascii") for m in POTRACE_PATH_RE.findall(svg_data) if m]
+    if paths:
+        return paths
+    
     import xml.etree.ElementTree as ET
     
     try:
-        tree = ET.parse(svg_path)
-        root = tree.getroot()
-        ns = {"svg": "http://www.w3.org/2000/svg"}
+        root = ET.fromstring(svg_data)
         
         paths = []
         # potrace outputs paths inside a group
@@ -566,62 +905,61 @@ def extract_potrace_paths(svg_path: str) -> list[str]:
         return []
 
 
-def build_inkstitch_svg(
+def write_inkstitch_svg(
+    svg_file: str,
     svg_paths: list[dict],
     width_px: int,
     height_px: int,
     px_per_mm: float,
-    stitch_params: dict,
-) -> str:
+    stitch_params: Mapping[str, str],
+):
     """
-    Build an SVG document with inkstitch namespace attributes for each color region.
+    Write an SVG document with inkstitch namespace attributes for each color region.
     
     Potrace outputs paths in pixel coordinates. We need to set the SVG viewBox
-    and dimensions in mm so Ink/Stitch knows the physical size.
+    and dimensions in mm so Ink/Stitch knows the physical size. Path data is
+    streamed into a buffered file rather than assembled as one string.
     """
     width_mm = width_px / px_per_mm
     height_mm = height_px / px_per_mm
     
     # Build stitch param attributes string
-    param_attrs = " ".join(f'{k}="{v}"' for k, v in stitch_params.items())
-    
-    paths_xml = []
-    for region in svg_paths:
-        color = region["color"]
-        for j, path_d in enumerate(region["paths"]):
-            path_id = f"region_{region['index']}_{j}"
-            # Ink/Stitch reads fill color for thread assignment
-            # and inkstitch:* attributes for stitch parameters
-            paths_xml.append(
-                f'  <path id="{path_id}" '
-                f'style="fill:{color};stroke:none;fill-opacity:1" '
-                f'd="{path_d}" '
-                f'{param_attrs} />'
-            )
+    param_attrs = param_attrs_string(tuple(stitch_params.items()))
     
-    svg = f"""<?xml version="1.0" encoding="UTF-8"?>
+    with open(svg_file, "w", buffering=1 << 20) as f:
+        f.write(f"""<?xml version="1.0" encoding="UTF-8"?>
 <svg xmlns="http://www.w3.org/2000/svg"
      xmlns:inkstitch="http://inkstitch.org/namespace"
      xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
      width="{width_mm}mm"
      height="{height_mm}mm"
      viewBox="0 0 {width_px} {height_px}">
-{chr(10).join(paths_xml)}
-</svg>"""
-    
-    return svg
+""")
+        for region in svg_paths:
+            # Ink/Stitch reads fill color for thread assignment
+            # and inkstitch:* attributes for stitch parameters; everything
+            # but the id and path data is shared by the region
+            id_prefix = f'  <path id="region_{region["index"]}_'
+            style = f'" style="fill:{region["color"]};stroke:none;fill-opacity:1" d="'
+            suffix = f'" {param_attrs} />\n'
+            for j, path_d in enumerate(region["paths"]):
+                f.write(f"{id_prefix}{j}{style}{path_d}{suffix}")
+        f.write("</svg>")
 
 
-def extract_pes_from_zip(zip_bytes: bytes) -> Optional[bytes]:
-    """Extract .pes file from Ink/Stitch zip output."""
+def extract_pes_from_zip(zip_file: Union[bytes, IO[bytes]]) -> Optional[bytes]:
+    """Extract .pes file from Ink/Stitch zip output (raw bytes or a seekable file)."""
+    if isinstance(zip_file, bytes):
+        zip_file = io.BytesIO(zip_file)
     try:
-        zf = zipfile.ZipFile(io.BytesIO(zip_bytes))
-        for name in zf.namelist():
-            if name.lower().endswith(".pes"):
-                return zf.read(name)
-        # If no .pes, return first file
-        if zf.namelist():
-            return zf.read(zf.namelist()[0])
+        with zipfile.ZipFile(zip_file) as zf:
+            names = zf.namelist()
+            for name in names:
+                if name.lower().endswith(".pes"):
+                    return zf.read(name)
+            # If no .pes, return first file
+            if names:
+                return zf.read(names[0])
     except Exception as e:
         logger.warning(f"Failed to extract from zip: {e}")
     return None
@@ -630,40 +968,121 @@ def extract_pes_from_zip(zip_bytes: bytes) -> Optional[bytes]:
 def order_colors_by_mapping(
     detected: np.ndarray, thread_colors: list[str]
 ) -> list[np.ndarray]:
-    """Order detected colors to match the provided thread color list."""
-    from colorsys import rgb_to_hsv
+    """
+    Order detected colors to match the provided thread color list.
     
-    def hex_to_rgb(h):
-        h = h.lstrip("#")
-        return tuple(int(h[i:i+2], 16) for i in (0, 2, 4))
+    Each thread color in turn takes the closest detected color not already
+    taken (greedy, so earlier threads get first pick). All distances come
+    from one broadcast; only the per-thread pick is a Python loop.
+    """
+    if len(detected) == 0:
+        return []
     
-    def color_distance(c1, c2):
-        return sum((a - b) ** 2 for a, b in zip(c1, c2))
+    targets = np.array(
+        [tuple(bytes.fromhex(h.lstrip("#")[:6])) for h in thread_colors], dtype=np.int32
+    ).reshape(-1, 3)
+    diff = detected.astype(np.int32)[np.newaxis, :, :] - targets[:, np.newaxis, :]
+    cost = np.einsum("tdc,tdc->td", diff, diff).astype(np.float64)
     
+    taken = np.zeros(len(detected), dtype=bool)
     ordered = []
-    remaining = list(detected)
-    
-    for hex_color in thread_colors:
-        target = hex_to_rgb(hex_color)
-        if not remaining:
-            break
-        # Find closest remaining color
-        best_idx = min(range(len(remaining)), key=lambda i: color_distance(tuple(remaining[i]), target))
-        ordered.append(remaining.pop(best_idx))
+    for row in cost[:len(detected)]:
+        row[taken] = np.inf
+        best = int(np.argmin(row))
+        taken[best] = True
+        ordered.append(detected[best])
     
     # Append any unmatched colors
-    ordered.extend(remaining)
+    ordered.extend(detected[i] for i in np.flatnonzero(~taken))
     return ordered
 
 
-def sort_colors_by_area(
-    arr: np.ndarray, colors: np.ndarray, fg_mask: np.ndarray
-) -> list[np.ndarray]:
-    """Sort colors by pixel count (largest area first) — typical embroidery order."""
-    counts = []
-    for color in colors:
-        mask = np.all(arr == color, axis=2) & fg_mask
-        counts.append(np.sum(mask))
+def color_label_map(
+    arr: np.ndarray, fg_mask: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Label every pixel by its color in a single np.unique pass.
+    
+    Returns (colors, labels, counts): the unique foreground colors (K, 3) in
+    sorted RGB order, an (H, W) label image where background pixels get
+    label K, and the foreground pixel count of each color. Labels use the
+    narrowest unsigned dtype that fits, so each per-color mask in the potrace
+    loop is a compare over one byte per pixel for typical palettes.
+    """
+    packed = (
+        (arr[..., 0].astype(np.uint32) << 16)
+        | (arr[..., 1].astype(np.uint32) << 8)
+        | arr[..., 2]
+    )
+    packed[~fg_mask] = 0xFFFFFFFF  # above any 24-bit color, so it sorts last
+    
+    uniq, inverse, counts = np.unique(packed.ravel(), return_inverse=True, return_counts=True)
+    if uniq[-1] == 0xFFFFFFFF:
+        uniq, counts = uniq[:-1], counts[:-1]
     
+    colors = np.stack([(uniq >> 16) & 0xFF, (uniq >> 8) & 0xFF, uniq & 0xFF], axis=1).astype(np.uint8)
+    labels = inverse.reshape(fg_mask.shape).astype(np.min_scalar_type(len(colors)))
+    return colors, labels, counts
+
+
+def quantize_label_map(
+    colors: np.ndarray,
+    labels: np.ndarray,
+    counts: np.ndarray,
+    n_colors: int,
+    sample_size: int = 8000,
+    n_iter: int = 20,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Reduce a color label map (from color_label_map) to at most n_colors.
+    
+    K-means++ / Lloyd runs on an area-weighted sample of the unique
+    foreground colors, then every unique color (not every pixel) is assigned
+    to its nearest center, so the label image is remapped with one lookup.
+    Returns (colors, labels, counts) in the same form as color_label_map.
+    """
+    rng = np.random.default_rng(0)
+    points = colors.astype(np.float32)
+    
+    # Area-weighted sample of the unique colors
+    sample = points[rng.choice(len(points), sample_size, p=counts / counts.sum())]
+    
+    def nearest(pts, centers):
+        # |p - c|^2 = |p|^2 - 2 p.c + |c|^2 (|p|^2 is constant per row)
+        return np.argmin((centers * centers).sum(axis=1) - 2 * pts @ centers.T, axis=1)
+    
+    # k-means++ seeding
+    k = min(n_colors, len(points))
+    centers = sample[[rng.integers(len(sample))]]
+    for _ in range(1, k):
+        d2 = ((sample[:, np.newaxis, :] - centers[np.newaxis]) ** 2).sum(axis=2).min(axis=1)
+        if d2.sum() == 0:
+            break
+        centers = np.vstack([centers, sample[rng.choice(len(sample), p=d2 / d2.sum())]])
+    
+    # Lloyd iterations
+    for _ in range(n_iter):
+        assign = nearest(sample, centers)
+        moved = np.array([
+            sample[assign == c].mean(axis=0) if np.any(assign == c) else centers[c]
+            for c in range(len(centers))
+        ])
+        if np.allclose(moved, centers, atol=0.5):
+            break
+        centers = moved
+    
+    # Map every unique color to a center; merge centers that round together
+    new_colors, remap = np.unique(np.rint(centers).astype(np.uint8), axis=0, return_inverse=True)
+    assign = remap.ravel()[nearest(points, centers)]
+    
+    # Background label -> new background label
+    lut = np.append(assign, len(new_colors)).astype(np.min_scalar_type(len(new_colors)))
+    new_counts = np.bincount(assign, weights=counts, minlength=len(new_colors)).astype(np.int64)
+    
+    return new_colors, lut[labels], new_counts
+
+
+def sort_colors_by_area(colors: np.ndarray, counts: np.ndarray) -> list[np.ndarray]:
+    """Sort colors by pixel count (largest area first) — typical embroidery order."""
     indices = np.argsort(counts)[::-1]
     return [colors[i] for i in indices]